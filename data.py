@@ -1,15 +1,77 @@
 import os
 import argparse
 import glob
-import random
+import shutil
+import tempfile
+import warnings
 from abc import ABC, abstractmethod
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice, repeat
 
 import PIL
 import numpy as np
 import json
 
+import torch
+from torch.nn import functional as F
 from tqdm import tqdm
 
+# bump whenever decoding or resampling changes, so that stale caches are not reused
+_CACHE_VERSION = 2
+
+
+def _load_img(img_path, draft_size=None):
+	img = PIL.Image.open(img_path)
+
+	if draft_size is not None:
+		img.draft('RGB', (draft_size, draft_size))
+
+	return np.asarray(img)
+
+
+def _load_crop_resize_batch(args):
+	img_paths, crop_box, img_size = args
+
+	imgs = np.empty(shape=(len(img_paths), img_size, img_size, 3), dtype=np.uint8)
+	for i, img_path in enumerate(img_paths):
+		imgs[i] = _load_crop_resize(img_path, crop_box, img_size)
+
+	return imgs
+
+
+def _load_crop_resize(img_path, crop_box, img_size):
+	y0, y1, x0, x1 = crop_box
+	img = PIL.Image.open(img_path).crop((x0, y0, x1, y1))
+
+	return np.asarray(_resize(img, img_size), dtype=np.uint8)
+
+
+def _read_identity_map(identity_map_path):
+	img_names, identities = np.loadtxt(identity_map_path, dtype=str, unpack=True)
+	return img_names, identities
+
+
+def _read_attributes(attributes_path):
+	with open(attributes_path, 'r') as fp:
+		lines = fp.read().splitlines()
+
+	attribute_names = lines[1].split()
+
+	raw = np.loadtxt(lines[2:], dtype=str)
+	img_names = raw[:, 0]
+	attributes = raw[:, 1:].astype(np.int8)
+	attributes[attributes == -1] = 0
+
+	img_index = {os.path.splitext(img_name)[0]: i for i, img_name in enumerate(img_names)}
+	return attributes, img_index, attribute_names
+
+
+def _resize(img, img_size):
+	if img.size == (img_size, img_size):
+		return img
+
+	return img.resize(size=(img_size, img_size), resample=PIL.Image.BICUBIC, reducing_gap=2.0)
+
 
 class DataSet(ABC):
 
@@ -22,6 +84,57 @@ class DataSet(ABC):
 	def read(self):
 		pass
 
+	def _read_cached(self, cache_root, cache_name, cache_params, read_fn):
+		if cache_root is None:
+			return read_fn()
+
+		cache_dir = os.path.join(cache_root, '{}-v{}'.format(cache_name, _CACHE_VERSION))
+		manifest = dict(cache_params, version=_CACHE_VERSION)
+
+		if self.__cache_matches(cache_dir, manifest):
+			warnings.warn('loading cached arrays from {} (decoding options such as --n-workers and --memmap-dir are ignored)'.format(cache_dir))
+
+			return {
+				os.path.splitext(f)[0]: np.load(os.path.join(cache_dir, f), mmap_mode='r')
+				for f in os.listdir(cache_dir) if f.endswith('.npy')
+			}
+
+		data = read_fn()
+
+		tmp_dir = None
+		try:
+			os.makedirs(cache_root, exist_ok=True)
+			tmp_dir = tempfile.mkdtemp(prefix=os.path.basename(cache_dir) + '.', dir=cache_root)
+			for name, array in data.items():
+				np.save(os.path.join(tmp_dir, name + '.npy'), array)
+
+			with open(os.path.join(tmp_dir, 'manifest.json'), 'w') as fp:
+				json.dump(manifest, fp)
+
+			if os.path.exists(cache_dir) and not self.__cache_matches(cache_dir, manifest):
+				shutil.rmtree(cache_dir, ignore_errors=True)
+
+			os.rename(tmp_dir, cache_dir)
+
+		except OSError as e:
+			# either the cache dir is not writable or a concurrent run has already populated the cache
+			if not self.__cache_matches(cache_dir, manifest):
+				warnings.warn('failed to write cache to {}: {}'.format(cache_dir, e))
+
+			if tmp_dir is not None:
+				shutil.rmtree(tmp_dir, ignore_errors=True)
+
+		return data
+
+	@staticmethod
+	def __cache_matches(cache_dir, manifest):
+		manifest_path = os.path.join(cache_dir, 'manifest.json')
+		if not os.path.exists(manifest_path):
+			return False
+
+		with open(manifest_path, 'r') as fp:
+			return json.load(fp) == manifest
+
 
 class AFHQ(DataSet):
 
@@ -31,27 +144,59 @@ class AFHQ(DataSet):
 		parser = argparse.ArgumentParser()
 		parser.add_argument('-sp', '--split', type=str, choices=['train', 'test'], required=True)
 		parser.add_argument('-is', '--img-size', type=int, default=256)
+		parser.add_argument('-nw', '--n-workers', type=int, default=os.cpu_count())
+		parser.add_argument('-cd', '--cache-dir', type=str, required=False)
 
 		args = parser.parse_args(extras)
 		self.__dict__.update(vars(args))
 
 	def read(self):
+		return self._read_cached(
+			self.cache_dir, 'afhq-{}-x{}'.format(self.split, self.img_size),
+			dict(split=self.split, img_size=self.img_size),
+			self.__read
+		)
+
+	def __read(self):
 		domains = sorted(os.listdir(os.path.join(self._base_dir, self.split)))
 
-		imgs = []
+		img_paths = []
 		domain_ids = []
 
 		for i, domain in enumerate(domains):
 			domain_dir = os.path.join(self._base_dir, self.split, domain)
 			domain_img_paths = [os.path.join(domain_dir, f) for f in os.listdir(domain_dir)]
 
-			for f in tqdm(domain_img_paths):
-				img = PIL.Image.open(f).resize(size=(self.img_size, self.img_size), resample=PIL.Image.BICUBIC)
-				imgs.append(np.array(img))
-				domain_ids.append(i)
+			img_paths.extend(domain_img_paths)
+			domain_ids.extend([i] * len(domain_img_paths))
+
+		imgs = np.empty(shape=(len(img_paths), self.img_size, self.img_size, 3), dtype=np.uint8)
+
+		device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+
+		batch_size = 256
+		with ProcessPoolExecutor(max_workers=self.n_workers) as executor:
+			decoded_imgs = executor.map(_load_img, img_paths, repeat(self.img_size), chunksize=64)
+
+			for b in tqdm(range(0, len(img_paths), batch_size)):
+				batch_imgs = np.stack(list(islice(decoded_imgs, batch_size)), axis=0)
+
+				if batch_imgs.shape[1:3] == (self.img_size, self.img_size):
+					imgs[b:b+batch_size] = batch_imgs
+					continue
+
+				downscale = batch_imgs.shape[1] > self.img_size
+
+				batch_imgs = torch.from_numpy(batch_imgs).to(device).permute(0, 3, 1, 2).float()
+				if downscale:
+					batch_imgs = F.interpolate(batch_imgs, size=(self.img_size, self.img_size), mode='area')
+				else:
+					batch_imgs = F.interpolate(batch_imgs, size=(self.img_size, self.img_size), mode='bicubic', align_corners=False)
+
+				imgs[b:b+batch_size] = batch_imgs.round().clamp(0, 255).byte().permute(0, 2, 3, 1).cpu().numpy()
 
 		return {
-			'imgs': np.stack(imgs, axis=0),
+			'imgs': imgs,
 			'domain': np.array(domain_ids, dtype=np.int16)
 		}
 
@@ -68,57 +213,43 @@ class CelebAHQ(DataSet):
 		args = parser.parse_args(extras)
 		self.__dict__.update(vars(args))
 
-	def __read_attributes(self):
-		with open(os.path.join(self._base_dir, 'CelebAMask-HQ', 'CelebAMask-HQ-attribute-anno.txt'), 'r') as fp:
-			lines = fp.read().splitlines()
-
-		attribute_names = lines[1].split()
-		attributes = dict()
-		for line in lines[2:]:
-			tokens = line.split()
-			img_name = os.path.splitext(tokens[0])[0]
-			img_attributes = np.array(list(map(int, tokens[1:])))
-			img_attributes[img_attributes == -1] = 0
-			attributes[img_name] = img_attributes
-
-		return attributes, attribute_names
-
 	def read(self):
 		img_names = sorted(os.listdir(os.path.join(self._base_dir, 'imgs')))
-		attributes_map, attribute_names = self.__read_attributes()
+		attribute_values, attribute_index, attribute_names = _read_attributes(
+			os.path.join(self._base_dir, 'CelebAMask-HQ', 'CelebAMask-HQ-attribute-anno.txt')
+		)
 
 		mask_paths = glob.glob(os.path.join(self._base_dir, 'CelebAMask-HQ', 'CelebAMask-HQ-mask-anno', '*', '*.png'))
 		masks_index = dict()
 		for mask_path in mask_paths:
-			mask_id = os.path.splitext(os.path.basename(mask_path))[0].split('_')[0]
-			if mask_id not in masks_index:
-				masks_index[mask_id] = list()
+			mask_id, part = os.path.splitext(os.path.basename(mask_path))[0].split('_', maxsplit=1)
+			masks_index.setdefault(mask_id, None)
+			if part == self.part:
+				masks_index[mask_id] = mask_path
 
-			masks_index[mask_id].append(mask_path)
+		img_ids = [os.path.splitext(img_name)[0] for img_name in img_names]
 
 		imgs = np.empty(shape=(len(img_names), self.img_size, self.img_size, 3), dtype=np.uint8)
 		masks = np.empty(shape=(len(img_names), self.img_size, self.img_size), dtype=np.uint8)
-		attributes = np.full(shape=(len(img_names), 40), fill_value=-1, dtype=np.int16)
 
 		for i, img_name in enumerate(tqdm(img_names)):
 			img_path = os.path.join(self._base_dir, 'imgs', img_name)
 
 			img = PIL.Image.open(img_path)
-			imgs[i] = np.array(img.resize(size=(self.img_size, self.img_size), resample=PIL.Image.BICUBIC))
+			imgs[i] = np.asarray(_resize(img, self.img_size))
 
-			img_id = os.path.splitext(img_name)[0]
-			mask_id = '{:05d}'.format(int(img_id))
+			mask_id = '{:05d}'.format(int(img_ids[i]))
 
-			masks[i] = np.zeros(shape=(self.img_size, self.img_size), dtype=np.uint8)
-			for mask_path in masks_index[mask_id]:
-				part = '_'.join(os.path.splitext(os.path.basename(mask_path))[0].split('_')[1:])
-				if part == self.part:
-					mask = PIL.Image.open(mask_path)
-					mask = np.array(mask.resize(size=(self.img_size, self.img_size), resample=PIL.Image.BICUBIC))
-					masks[i] = mask[..., 0] // 255
-					break
+			mask_path = masks_index[mask_id]
 
-			attributes[i] = attributes_map[img_id]
+			masks[i] = 0
+			if mask_path is not None:
+				mask = PIL.Image.open(mask_path)
+				mask = np.asarray(_resize(mask, self.img_size))
+				masks[i] = mask[..., 0]
+
+		np.floor_divide(masks, 255, out=masks)
+		attributes = attribute_values[[attribute_index[img_id] for img_id in img_ids]]
 
 		gender = attributes[:, attribute_names.index('Male')]
 
@@ -141,27 +272,27 @@ class FFHQ(DataSet):
 		self.__dict__.update(vars(args))
 
 	def read(self):
-		imgs = np.empty(shape=(70000, self.img_size, self.img_size, 3), dtype=np.uint8)
 		age = np.full(shape=(70000,), fill_value=-1, dtype=np.float32)
 
-		img_ids = np.arange(70000)
-		for i in tqdm(img_ids):
-			img_path = os.path.join(self._base_dir, 'imgs', '{:05d}.png'.format(i))
-
-			img = PIL.Image.open(img_path)
-			imgs[i] = np.array(img.resize(size=(self.img_size, self.img_size), resample=PIL.Image.BICUBIC))
-
+		for i in range(70000):
 			features_path = os.path.join(self._base_dir, 'features', '{:05d}.json'.format(i))
 			with open(features_path, 'r') as features_fp:
 				features = json.load(features_fp)
 				if len(features) != 0:
 					age[i] = features[0]['faceAttributes']['age']
 
-		valid_idx = (age != -1)
+		img_ids = np.where(age != -1)[0]
+		imgs = np.empty(shape=(img_ids.size, self.img_size, self.img_size, 3), dtype=np.uint8)
+
+		for i, img_id in enumerate(tqdm(img_ids)):
+			img_path = os.path.join(self._base_dir, 'imgs', '{:05d}.png'.format(img_id))
+
+			img = PIL.Image.open(img_path)
+			imgs[i] = np.asarray(_resize(img, self.img_size))
 
 		return {
-			'imgs': imgs[valid_idx],
-			'age': age[valid_idx].astype(np.int16) // 10
+			'imgs': imgs,
+			'age': age[img_ids].astype(np.int16) // 10
 		}
 
 
@@ -174,6 +305,9 @@ class CelebA(DataSet):
 		parser.add_argument('-cs', '--crop-size', type=int, default=128)
 		parser.add_argument('-is', '--img-size', type=int, default=128)
 		parser.add_argument('-ni', '--n-identities', type=int, required=False)
+		parser.add_argument('-nw', '--n-workers', type=int, default=os.cpu_count())
+		parser.add_argument('-cd', '--cache-dir', type=str, required=False)
+		parser.add_argument('-md', '--memmap-dir', type=str, required=False)
 
 		args = parser.parse_args(extras)
 		self.__dict__.update(vars(args))
@@ -182,45 +316,60 @@ class CelebA(DataSet):
 		self.__identity_map_path = os.path.join(self._base_dir, 'Anno', 'identity_CelebA.txt')
 
 	def __list_imgs(self):
-		with open(self.__identity_map_path, 'r') as fd:
-			lines = fd.read().splitlines()
+		img_names, identities = _read_identity_map(self.__identity_map_path)
+		img_paths = np.char.add(self.__imgs_dir + os.sep, np.char.replace(img_names, '.jpg', '.png'))
 
-		img_paths = []
-		identities = []
+		return img_paths, identities
 
-		for line in lines:
-			img_name, identity = line.split(' ')
-			img_path = os.path.join(self.__imgs_dir, os.path.splitext(img_name)[0] + '.png')
+	def __allocate(self, name, shape, dtype):
+		if self.memmap_dir is None:
+			return np.empty(shape=shape, dtype=dtype)
 
-			img_paths.append(img_path)
-			identities.append(identity)
-
-		return img_paths, identities
+		return np.lib.format.open_memmap(os.path.join(self.memmap_dir, name + '.npy'), mode='w+', shape=shape, dtype=dtype)
 
 	def read(self):
+		if self.n_identities:
+			return self.__read()
+
+		return self._read_cached(
+			self.cache_dir, 'celeba-x{}-c{}'.format(self.img_size, self.crop_size),
+			dict(img_size=self.img_size, crop_size=self.crop_size),
+			self.__read
+		)
+
+	def __read(self):
 		img_paths, identity_ids = self.__list_imgs()
-		unique_identities = list(set(identity_ids))
 
 		if self.n_identities:
-			unique_identities = random.sample(unique_identities, k=self.n_identities)
-			img_paths, identity_ids = zip(*[(path, identity) for path, identity in zip(img_paths, identity_ids) if identity in unique_identities])
+			sampled_identities = np.random.choice(np.unique(identity_ids), size=self.n_identities, replace=False)
+			sampled_idx = np.isin(identity_ids, sampled_identities)
+			img_paths, identity_ids = img_paths[sampled_idx], identity_ids[sampled_idx]
 
-		imgs = np.empty(shape=(len(img_paths), self.img_size, self.img_size, 3), dtype=np.uint8)
-		identities = np.empty(shape=(len(img_paths), ), dtype=np.int16)
+		unique_identities, identity_classes = np.unique(identity_ids, return_inverse=True)
+
+		imgs = self.__allocate('imgs', shape=(len(img_paths), self.img_size, self.img_size, 3), dtype=np.uint8)
+		identities = self.__allocate('identity', shape=(len(img_paths), ), dtype=np.int16)
+
+		with PIL.Image.open(img_paths[0]) as img:
+			width, height = img.size
+
+		crop_box = (
+			height // 2 - self.crop_size // 2, height // 2 + self.crop_size // 2,
+			width // 2 - self.crop_size // 2, width // 2 + self.crop_size // 2
+		)
 
-		for i in tqdm(range(len(img_paths))):
-			img = PIL.Image.open(img_paths[i])
-			img = np.array(img)
+		batch_size = 256
+		tasks = [(img_paths[b:b+batch_size], crop_box, self.img_size) for b in range(0, len(img_paths), batch_size)]
 
-			img = img[
-				(img.shape[0] // 2 - self.crop_size // 2):(img.shape[0] // 2 + self.crop_size // 2),
-				(img.shape[1] // 2 - self.crop_size // 2):(img.shape[1] // 2 + self.crop_size // 2)
-			]
+		with ProcessPoolExecutor(max_workers=self.n_workers) as executor:
+			for t, batch_imgs in enumerate(tqdm(executor.map(_load_crop_resize_batch, tasks), total=len(tasks))):
+				imgs[t*batch_size:(t+1)*batch_size] = batch_imgs
 
-			img = PIL.Image.fromarray(img).resize(size=(self.img_size, self.img_size), resample=PIL.Image.BICUBIC)
-			imgs[i] = np.array(img)
+		identities[:] = identity_classes
 
-			identities[i] = unique_identities.index(identity_ids[i])
+		if isinstance(imgs, np.memmap):
+			imgs.flush()
+			identities.flush()
 
 		return {
 			'imgs': imgs,
@@ -41,6 +41,10 @@ class NamedDataset(data.Dataset):
 		return len(self.paths)
 
 
+def to_chw_tensor(img):
+	return torch.from_numpy(np.asarray(img)).permute(2, 0, 1)
+
+
 @torch.no_grad()
 def face_embeddings(img_dir):
 	device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
@@ -69,6 +73,32 @@ def face_embeddings(img_dir):
 	return embeddings
 
 
+@torch.no_grad()
+def face_landmarks(img_dir):
+	device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+
+	fa = face_alignment.FaceAlignment(face_alignment.LandmarksType._2D, flip_input=False, device=device.type)
+
+	dataset = NamedDataset(root=img_dir, transform=to_chw_tensor)
+
+	data_loader = DataLoader(
+		dataset, batch_size=64, num_workers=8,
+		shuffle=False, pin_memory=True, drop_last=False
+	)
+
+	landmarks = {}
+	for batch_paths, batch_imgs in tqdm(data_loader):
+		batch_landmarks = fa.get_landmarks_from_batch(batch_imgs.to(device, non_blocking=True).float())
+		if batch_landmarks is None:
+			continue
+
+		for p, path in enumerate(batch_paths):
+			if len(batch_landmarks[p]) != 0:
+				landmarks[path] = batch_landmarks[p].reshape(-1, 68, 2)
+
+	return landmarks
+
+
 @torch.no_grad()
 def head_poses(img_dir, hopenet_path):
 	device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
@@ -133,9 +163,8 @@ def eval_metrics(args):
 	translations_dir = os.path.join(args.eval_dir, 'translations')
 
 	print('# detecting landmarks')
-	fa = face_alignment.FaceAlignment(face_alignment.LandmarksType._2D, flip_input=False)
-	content_landmarks = map_by_id(fa.get_landmarks_from_directory(path=os.path.join(translations_dir, 'content')))
-	translation_landmarks = map_by_id(fa.get_landmarks_from_directory(path=os.path.join(translations_dir, 'translation')))
+	content_landmarks = map_by_id(face_landmarks(img_dir=os.path.join(translations_dir, 'content')))
+	translation_landmarks = map_by_id(face_landmarks(img_dir=os.path.join(translations_dir, 'translation')))
 
 	print('# computing face embedding')
 	style_embeddings = map_by_id(face_embeddings(img_dir=os.path.join(translations_dir, 'style')))